@@ -18,6 +18,13 @@ myStudy = psb.ParametricStudy(
 # myStudy.multipleJobsPerNode = True
 # myStudy.executableName = 'sleep'
 
+# uncomment next three lines to run jobs in node-local scratch ($TMPDIR)
+# and copy back the files the job created or changed that match the
+# globs as one archive per set
+# myStudy.stageToScratch = True
+# myStudy.executableName = 'sleep'
+# myStudy.stageOutputGlobs = ['*.txt','*.out']
+
 # build the study directory structure and populate with
 # modified input files and job submission scripts
 myStudy.build()
@@ -25,3 +32,12 @@ myStudy.build()
 # submit jobs to the HPC cluster
 jobs_to_run_concurrently = 5
 myStudy.hpcExecute(jobs_to_run_concurrently)
+
+# uncomment next lines to refine the study later on. Only the new
+# parameter sets are built and submitted, old ones are left untouched.
+# 'e' is a new parameter, the already built sets used e = 0.
+# myStudy.extend(
+#         {'a':[1.5,2.5],'e':[1]},
+#         defaults={'e':0},
+#         numConcJobs=jobs_to_run_concurrently
+#         )
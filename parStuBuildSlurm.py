@@ -1,6 +1,9 @@
+import ast
 import os
+import re
 import shutil
 import subprocess as sp
+import tarfile
 import time
 
 class ParametricStudy:
@@ -29,6 +32,8 @@ class ParametricStudy:
         self.executableName = None
         self.coresPerNode = 16
         self.coresPerJob = 1
+        self.stageToScratch = False
+        self.stageOutputGlobs = ['*']
         # "private" members
         self._startDir = os.getcwd()+'/'
         self._numOfParamSets = None
@@ -41,6 +46,9 @@ class ParametricStudy:
         self._jobsPerNode = None
         self._numNodes = None
         self._leftOverJobs = None
+        self._jobScriptsDirName = 'jobScripts'
+        self._addedDefaults = {}
+        self._stagedArchiveName = 'stagedOutputs.tar.gz'
 
         validKwargs = {
                 'studyName':self.studyName,
@@ -102,9 +110,9 @@ class ParametricStudy:
             print('initialized include:')
             for mem in classMembers:
                 print(mem)
-        # if running more than 1 job per node check to make sure certain
-        # attributes have been initialized
-        if self.multipleJobsPerNode:
+        # if running more than 1 job per node or staging to node-local scratch
+        # check to make sure certain attributes have been initialized
+        if self.multipleJobsPerNode or self.stageToScratch:
             if self.executableName == None:
                 print('must define the executableName attribute with the')
                 print('executable file\'s name (string type).')
@@ -177,24 +185,34 @@ class ParametricStudy:
 
 
 
-    def _createDirStructure(self):
+    def _setDirName(self,s):
+        """Create the sub-directory name of a single parameter set."""
+        name = ''
+        for param in sorted(s):
+            # check for grouped parameters
+            if type(s[param]) == list:
+                name += str(param)
+                for val in s[param]:
+                    name += '-'+str(val)
+            else:
+                name += str(param)+str(s[param])
+        return name
+
+
+
+
+
+    def _createDirStructure(self,newStudy=True):
         """Create the main study directory and a sub-directory for each parameter set."""
-        # make the main study directory
-        os.makedirs(self._startDir + self.studyName)
+        # make the main study directory (it already exists when extending a study)
+        if newStudy:
+            os.makedirs(self._startDir + self.studyName)
 
         # create sub directory names
         self._subDir = []
         self._subDirName = []
         for s in self._listOfSets:
-            name = ''
-            for param in sorted(s):
-                # check for grouped parameters
-                if type(s[param]) == list:
-                    name += str(param)
-                    for val in s[param]:
-                        name += '-'+str(val)
-                else:
-                    name += str(param)+str(s[param])
+            name = self._setDirName(s)
             # create path to sub-directory
             pathPlusSub = self._startDir+self.studyName+'/'+name
             # save sub-directory name and path for later use
@@ -207,9 +225,13 @@ class ParametricStudy:
 
 
 
-    def _saveStudyInfo(self):
+    def _saveStudyInfo(self,prevSubDirNames=None):
         """Write information about the study to a file named 'parStudyInfo.txt'."""
-        path = self.studyName + '/parStudyInfo.txt'
+        path = self._startDir + self.studyName + '/parStudyInfo.txt'
+        # sub-directories built before the study was extended are kept in the list
+        allSubDirNames = list(self._subDirName)
+        if prevSubDirNames != None:
+            allSubDirNames += prevSubDirNames
         with open(path,'w') as fout:
             # write header
             fout.write('Parameters varied and their values:\n')
@@ -217,9 +239,15 @@ class ParametricStudy:
             for par in sorted(self.parametric_info):
                 fout.write(par + ':\t'+str(self.parametric_info[par]))
                 fout.write('\n')
+            # write the values that sets built before a parameter was added used
+            if len(self._addedDefaults) > 0:
+                fout.write('Defaults of parameters added later:\n')
+                for par in sorted(self._addedDefaults):
+                    fout.write(par + ':\t'+repr(self._addedDefaults[par]))
+                    fout.write('\n')
             # write names of parameter set subdirectories
             fout.write('Unique parameter set directory names:\n')
-            for parSet in sorted(self._subDirName):
+            for parSet in sorted(allSubDirNames):
                 fout.write(parSet + '\n')
         fout.close()
 
@@ -227,6 +255,110 @@ class ParametricStudy:
 
 
 
+    def _loadStudyInfo(self):
+        """Read the parameters, added parameter defaults and sub-directory names of a built study from 'parStudyInfo.txt'."""
+        path = self._startDir + self.studyName + '/parStudyInfo.txt'
+        if not os.path.isfile(path):
+            print('could not find '+path+'. The study must be built')
+            print('before it can be extended.')
+            raise IOError('missing parStudyInfo.txt')
+        prevInfo = {}
+        prevDefaults = {}
+        prevSubDirNames = []
+        # the section being read decides where each line is stored
+        section = prevInfo
+        with open(path) as fin:
+            for line in fin:
+                line = line.split('\n')[0]
+                if line == 'Parameters varied and their values:':
+                    section = prevInfo
+                elif line == 'Defaults of parameters added later:':
+                    section = prevDefaults
+                elif line == 'Unique parameter set directory names:':
+                    section = prevSubDirNames
+                elif section is prevSubDirNames:
+                    if len(line) > 0:
+                        prevSubDirNames.append(line)
+                else:
+                    par, values = line.split(':\t',1)
+                    section[par] = ast.literal_eval(values)
+        fin.close()
+        return prevInfo, prevDefaults, prevSubDirNames
+
+
+
+
+
+    def _mergeParamValues(self,par,oldValues,newValues):
+        """Merge new values of a parameter (or group of parameters) into its old values."""
+        oldGrouped = type(oldValues[0]) == list
+        newGrouped = type(newValues[0]) == list
+        if oldGrouped != newGrouped or (oldGrouped and len(oldValues) != len(newValues)):
+            print('new values of '+str(par)+' do not have the same grouping')
+            print('as its previous values: '+str(oldValues))
+            raise ValueError('invalid parameter values')
+        # grouped parameters are merged as one tuple of values per parameter set
+        if oldGrouped:
+            oldValues = list(zip(*oldValues))
+            newValues = list(zip(*newValues))
+        # keep the old values in order and add the new values not already present
+        merged = list(oldValues)
+        for val in newValues:
+            if val not in merged:
+                merged.append(val)
+        if oldGrouped:
+            return [list(grpPar) for grpPar in zip(*merged)]
+        else:
+            return merged
+
+
+
+
+
+    def _mergeParametricInfo(self,prevInfo,newInfo,defaults):
+        """Merge new parameter values and new parameters into a built study's parametric_info."""
+        merged = {}
+        for par in prevInfo:
+            merged[par] = prevInfo[par]
+        for par in newInfo:
+            if par in prevInfo:
+                merged[par] = self._mergeParamValues(par,prevInfo[par],newInfo[par])
+            else:
+                # sets that were already built ran with the new parameter at its default value
+                if par not in defaults:
+                    print('new parameter '+str(par)+' needs a default value in "defaults".')
+                    print('It is the value the previously built parameter sets used.')
+                    raise ValueError('missing default value')
+                if type(newInfo[par][0]) == list:
+                    defaultValue = [[val] for val in defaults[par]]
+                else:
+                    defaultValue = [defaults[par]]
+                merged[par] = self._mergeParamValues(par,defaultValue,newInfo[par])
+        return merged
+
+
+
+
+
+    def _isPrevSet(self,s,prevInfo,defaults):
+        """Check if a parameter set was already built before the study was extended."""
+        for par in s:
+            if par in prevInfo:
+                # grouped parameter values are stored as one list per grouped parameter
+                if type(prevInfo[par][0]) == list:
+                    prevValues = [list(grpPar) for grpPar in zip(*prevInfo[par])]
+                else:
+                    prevValues = prevInfo[par]
+                if s[par] not in prevValues:
+                    return False
+            elif s[par] != defaults[par]:
+                return False
+        return True
+
+
+
+
+
     def _modInputFile(self,param,value,curInFi):
         """Uses lineMod function to modify input file parameters."""
         # create temporary copy of input file
@@ -295,6 +427,8 @@ class ParametricStudy:
                     for line in fin:
                         if '#SBATCH --job-name=' in line:
                             fout.write('#SBATCH --job-name='+self._subDirName[i]+'\n')
+                        elif self.stageToScratch and line.split('\n')[0] == self._execCommand:
+                            fout.write(self._stagedExecCommand(i,self._execCommand)+'\n')
                         else:
                             fout.write(line)
             fout.close()
@@ -305,16 +439,92 @@ class ParametricStudy:
 
 
 
+    def _stagedExecCommand(self,i,execCommand):
+        """Wrap the executable command so the job runs in node-local scratch and its outputs are copied back as one archive."""
+        scratch = '${TMPDIR:-/tmp}/'+self.studyName+'/'+self._subDirName[i]
+        archive = scratch+'.tar.gz'
+        marker = scratch+'.marker'
+        fileList = scratch+'.files'
+        # only files created or changed by the job that match the output globs are
+        # packed, SLURM log files are left out so they are never overwritten on unpack
+        globs = ' -o '.join(["-path './"+g+"'" for g in self.stageOutputGlobs])
+        excludes = ' '.join(["! -name '"+log+"'" for log in self._slurmLogPatterns()])
+        excludes += " ! -path './"+self._stagedArchiveName+"'"
+        lines = [
+                '# run in node-local scratch and stage the outputs back in a single archive',
+                '(',
+                'mkdir -p '+scratch,
+                'cp -rp '+self._subDir[i]+'/. '+scratch,
+                '# the marker is one second older than the job so no output shares its time stamp',
+                'touch -d "@$(( $(date +%s) - 1 ))" '+marker,
+                'cd '+scratch,
+                execCommand,
+                'stageRc=$?',
+                'find . -type f -newer '+marker+' \\( '+globs+' \\) '+excludes+' > '+fileList,
+                '# an empty archive is written on purpose when the job produced no outputs',
+                '# the scratch copy is only removed once the archive is safely copied back',
+                'if tar -czf '+archive+' -T '+fileList+' && cp '+archive+' '+self._subDir[i]+'/'+self._stagedArchiveName+'; then',
+                '    cd '+self._subDir[i],
+                '    rm -rf '+scratch+' '+archive+' '+marker+' '+fileList,
+                'else',
+                '    echo "staging outputs back failed, they are kept in '+scratch+'" >&2',
+                '    if [ $stageRc -eq 0 ]; then stageRc=1; fi',
+                'fi',
+                'exit $stageRc',
+                ')'
+                ]
+        return '\n'.join(lines)
+
+
+
+
+
+    def _slurmLogPatterns(self):
+        """Get file name patterns of the SLURM output and error files set in the default SLURM script."""
+        patterns = []
+        with open(self._startDir+self.defaultSLURMFileName) as fin:
+            for line in fin:
+                # options can be given as --output=name, --output name, -o name or -oname
+                match = re.match(r'#SBATCH\s+(?:--(?:output|error)(?:=|\s+)|-[oe](?:=|\s*))(\S+)',line)
+                if match:
+                    name = os.path.basename(match.group(1))
+                    # replace SLURM filename patterns like %j with a wildcard
+                    patterns.append(re.sub('%[0-9]*[A-Za-z%]','*',name))
+        fin.close()
+        # SLURM's default output file name
+        if len(patterns) == 0:
+            patterns.append('slurm-*.out')
+        return patterns
+
+
+
+
+
+    def _stagedWaitCommand(self):
+        """Wait for the staged jobs started in the background and keep a failed job's exit status."""
+        lines = [
+                'stagedRc=0',
+                'for pid in $stagedPids; do',
+                '    wait $pid || stagedRc=$?',
+                'done'
+                ]
+        return '\n'.join(lines)
+
+
+
+
+
     def _findExecCommand(self):
         "Finds the executable command in the default SLURM script."""
         # get the executable command line from the default SLURM file
+        # (#SBATCH directives and comments that mention the executable are skipped)
+        self._execCommand = None
         with open(self.defaultSLURMFileName) as fin:
             for line in fin:
-                if self.executableName in line:
-                    self._execCommand = line
+                if self.executableName in line and not line.lstrip().startswith('#'):
+                    # strip off new line character from executable command
+                    self._execCommand = line.split('\n')[0]
         fin.close
-        # strip off new line character from executable command
-        self._execCommand = self._execCommand.split('\n')[0]
 
         # check that the executable command was found in the SLURM file
         if self._execCommand == None:
@@ -349,7 +559,7 @@ class ParametricStudy:
     def _setupMultipleJobsPerNode(self):
         """Create job scripts that run more than one job per node."""
         # create directory for job scripts and populate with needed SLURM files
-        os.makedirs(self._startDir+self.studyName+'/jobScripts')
+        os.makedirs(self._startDir+self.studyName+'/'+self._jobScriptsDirName)
         jobCounter = 0
         jstart = 0
         jend = 0
@@ -357,7 +567,7 @@ class ParametricStudy:
             jstart = i*self._jobsPerNode+1
             jend = (i+1)*self._jobsPerNode
             jnum = str(jstart)+'-'+str(jend)
-            curSlurmFi = self._startDir+self.studyName+'/jobScripts/jobs'+jnum+'.slurm'
+            curSlurmFi = self._startDir+self.studyName+'/'+self._jobScriptsDirName+'/jobs'+jnum+'.slurm'
             os.system('cp '+self._startDir+self.defaultSLURMFileName+' '+curSlurmFi)
 
             # alter the SLURM script to run jobs assigned it
@@ -366,7 +576,7 @@ class ParametricStudy:
                     for line in fin:
                         if '#SBATCH --job-name=' in line:
                             fout.write('#SBATCH --job-name=jobs'+jnum+'\n')
-                        elif self.executableName in line:
+                        elif line.split('\n')[0] == self._execCommand:
                             fout.write('# go to job sub-directories and start jobs then wait\n')
                             writeStart = fout.tell()
                             break
@@ -375,13 +585,26 @@ class ParametricStudy:
 
                     # write bash code to SLURM file that starts and waits for jobs assigned this file
                     for j in range(self._jobsPerNode):
-                        fout.write('cd '+self._subDir[jobCounter]+'\n')
-                        fout.write(self._execCommand+'&\n')
+                        if self.stageToScratch:
+                            fout.write(self._stagedExecCommand(jobCounter,self._execCommand)+'&\n')
+                            fout.write('stagedPids="$stagedPids $!"\n')
+                        else:
+                            fout.write('cd '+self._subDir[jobCounter]+'\n')
+                            fout.write(self._execCommand+'&\n')
                         jobCounter += 1
-                    fout.write('wait\n')
+                    if self.stageToScratch:
+                        fout.write(self._stagedWaitCommand()+'\n')
+                    else:
+                        fout.write('wait\n')
                     # write the rest of the lines from the default SLURM file
+                    line = '\n'
                     for line in fin:
                         fout.write(line)
+                    # the job fails if one of the staged jobs failed
+                    if self.stageToScratch:
+                        if not line.endswith('\n'):
+                            fout.write('\n')
+                        fout.write('exit $stagedRc\n')
             fin.close()
             fout.close()
 
@@ -397,7 +620,7 @@ class ParametricStudy:
         jstart = jend + 1
         jend = jend + self._leftOverJobs
         jnum = str(jstart)+'-'+str(jend)
-        curSlurmFi = self._startDir+self.studyName+'/jobScripts/jobs'+jnum+'.slurm'
+        curSlurmFi = self._startDir+self.studyName+'/'+self._jobScriptsDirName+'/jobs'+jnum+'.slurm'
         os.system('cp '+self._startDir+self.defaultSLURMFileName+' '+curSlurmFi)
 
         # alter the SLURM script to run jobs assigned it
@@ -406,7 +629,7 @@ class ParametricStudy:
                 for line in fin:
                     if '#SBATCH --job-name=' in line:
                         fout.write('#SBATCH --job-name=jobs'+jnum+'\n')
-                    elif self.executableName in line:
+                    elif line.split('\n')[0] == self._execCommand:
                         fout.write('# go to job sub-directories and start jobs then wait\n')
                         writeStart = fout.tell()
                         break
@@ -415,13 +638,26 @@ class ParametricStudy:
 
                 # write bash code to SLURM file that starts and waits for jobs assigned this file
                 for j in range(self._leftOverJobs):
-                    fout.write('cd '+self._subDir[jobCounter]+'\n')
-                    fout.write(self._execCommand+'&\n')
+                    if self.stageToScratch:
+                        fout.write(self._stagedExecCommand(jobCounter,self._execCommand)+'&\n')
+                        fout.write('stagedPids="$stagedPids $!"\n')
+                    else:
+                        fout.write('cd '+self._subDir[jobCounter]+'\n')
+                        fout.write(self._execCommand+'&\n')
                     jobCounter += 1
-                fout.write('wait\n')
+                if self.stageToScratch:
+                    fout.write(self._stagedWaitCommand()+'\n')
+                else:
+                    fout.write('wait\n')
                 # write the rest of the lines from the default SLURM file
+                line = '\n'
                 for line in fin:
                     fout.write(line)
+                # the job fails if one of the staged jobs failed
+                if self.stageToScratch:
+                    if not line.endswith('\n'):
+                        fout.write('\n')
+                    fout.write('exit $stagedRc\n')
         fin.close()
         fout.close()
 
@@ -505,8 +741,8 @@ class ParametricStudy:
             print('changed to numConcJobs='+str(numConcJobs))
         assert numConcJobs <= self._numNodes and numConcJobs > 0
         # get list of multi-job SLURM scripts
-        jobScripts = os.listdir(self._startDir+self.studyName+'/jobScripts')
-        os.chdir(self._startDir+self.studyName+'/jobScripts')
+        jobScripts = os.listdir(self._startDir+self.studyName+'/'+self._jobScriptsDirName)
+        os.chdir(self._startDir+self.studyName+'/'+self._jobScriptsDirName)
         # start the first batch of jobs to run simultaneously
         for i in range(numConcJobs):
             # build the command to submit job to the HPC
@@ -558,6 +794,8 @@ class ParametricStudy:
         self._saveStudyInfo()
         self._createInputFiles()
         if not self.multipleJobsPerNode:
+            if self.stageToScratch:
+                assert(self._findExecCommand())
             self._setupJobScripts()
         else:
             assert(self._findExecCommand())
@@ -573,11 +811,71 @@ class ParametricStudy:
 
 
 
+    def extend(self,parametric_info,defaults=None,numConcJobs=None):
+        """Add parameter values or new parameters to a built study and build only the new parameter sets."""
+        print('\n\nExtending parametric study with new parameter sets...')
+        start = time.time()
+        if defaults == None:
+            defaults = {}
+        # all paths used by the build methods are relative to the starting directory
+        os.chdir(self._startDir)
+        prevInfo, self._addedDefaults, prevSubDirNames = self._loadStudyInfo()
+        self.parametric_info = self._mergeParametricInfo(prevInfo,parametric_info,defaults)
+        # record the values that the already built sets used for the added parameters
+        for par in parametric_info:
+            if par not in prevInfo:
+                self._addedDefaults[par] = defaults[par]
+        assert(self._checkBuildInit())
+
+        # keep only the parameter sets that have not been built yet
+        self._calcNumUniqueParamSets()
+        newSets = []
+        for s in self._listOfSets:
+            if not self._isPrevSet(s,prevInfo,defaults):
+                newSets.append(s)
+        self._listOfSets = newSets
+        self._numOfParamSets = len(newSets)
+        print('Found '+str(self._numOfParamSets)+' new parameter sets.')
+
+        self._createDirStructure(newStudy=False)
+        self._saveStudyInfo(prevSubDirNames)
+        if self._numOfParamSets > 0:
+            self._createInputFiles()
+            if not self.multipleJobsPerNode:
+                if self.stageToScratch:
+                    assert(self._findExecCommand())
+                self._setupJobScripts()
+            else:
+                # multi-job scripts of each extension go in their own directory
+                ext = 1
+                while os.path.isdir(self._startDir+self.studyName+'/jobScripts-ext'+str(ext)):
+                    ext += 1
+                self._jobScriptsDirName = 'jobScripts-ext'+str(ext)
+                assert(self._findExecCommand())
+                self._calcNumNodesNeeded()
+                je,jc = self._setupMultipleJobsPerNode()
+                if self._leftOverJobs > 0:
+                    self._handleLeftOverJobs(je,jc)
+        self._buildComplete = True
+        end = time.time()
+        print('Extended the study in '+str(end-start)+' seconds!')
+
+        # optionally submit only the new parameter sets
+        if numConcJobs != None:
+            self.hpcExecute(numConcJobs)
+
+
+
+
+
     def hpcExecute(self,numConcJobs):
         """Start parametric study jobs on the HPC using the "sbatch" command."""
         print('\n\nLaunching Jobs on the HPC using the following commands:\n')
         start = time.time()
         self._checkHpcExecInit(numConcJobs)
+        if self._numOfParamSets == 0:
+            print('No new parameter sets to launch.')
+            return
         self._allJobs = []
         if not self.multipleJobsPerNode:
             self._launchJobs(numConcJobs)
@@ -587,8 +885,9 @@ class ParametricStudy:
         # change back to the starting directory
         os.chdir(self._startDir+self.studyName)
         # write job IDs to a file in case they need to be deleted later
+        # (appended so job IDs from before the study was extended stay valid)
         print('\nWriting Job IDs file...')
-        with open('jobIDs.txt','w') as fout:
+        with open('jobIDs.txt','a') as fout:
             for jobID in self._allJobs:
                 fout.write(jobID.split()[3]+'\n')
         fout.close()
@@ -599,6 +898,44 @@ class ParametricStudy:
 
 
 
+    def unpackOutputs(self,removeArchives=False):
+        """Unpack the output archives of a study run with stageToScratch into their parameter set sub-directories."""
+        start = time.time()
+        # make sure studyName atribute is defined
+        bad = self.studyName == None
+        if bad:
+            print('must define attribute "studyName" before calling this method.')
+        assert not bad
+
+        print('\n\nUnpacking staged outputs of the parametric study...')
+        _, _, subDirNames = self._loadStudyInfo()
+        numUnpacked = 0
+        for name in subDirNames:
+            archive = self._startDir+self.studyName+'/'+name+'/'+self._stagedArchiveName
+            # jobs that have not finished yet have no archive
+            if not os.path.isfile(archive):
+                print('No staged outputs found for '+name)
+                continue
+            with tarfile.open(archive,'r:gz') as tar:
+                # an empty archive means the job finished without producing outputs
+                if len(tar.getmembers()) == 0:
+                    print('Job produced no staged outputs for '+name)
+                # extraction filters keep files inside the sub-directory where available
+                elif hasattr(tarfile,'data_filter'):
+                    tar.extractall(self._startDir+self.studyName+'/'+name,filter='data')
+                    numUnpacked += 1
+                else:
+                    tar.extractall(self._startDir+self.studyName+'/'+name)
+                    numUnpacked += 1
+            if removeArchives:
+                os.remove(archive)
+        end = time.time()
+        print('\nUnpacked '+str(numUnpacked)+' archives in '+str(end-start)+' seconds!')
+
+
+
+
+
     def batchDelete(self):
         """Delete all the jobs running on the HPC for a given parametric study."""
         start = time.time()